@@ -27,7 +27,121 @@ from __future__ import division
 import numpy as np
 from . import utilities
 from untwist.data import audio
-import untwist.utilities
+
+
+def _generator():
+    """
+    Returns a PCG64 generator seeded from NumPy's global random state, so that
+    ``np.random.seed`` makes the anchors reproducible.
+    """
+
+    return np.random.default_rng(np.random.randint(2**32, dtype=np.uint64))
+
+
+def _lowpass(x_fft, lowpass_cutoff, num_points, sample_rate):
+    """
+    Zeroes the bins of ``x_fft`` above ``lowpass_cutoff`` in place and returns
+    the index of the first zeroed bin (or the number of bins if
+    ``lowpass_cutoff`` is None).
+    """
+
+    if lowpass_cutoff is None:
+        return x_fft.shape[0]
+
+    cutoff = utilities.nearest_bin(lowpass_cutoff, num_points, sample_rate)
+    x_fft[cutoff:] = 0
+
+    return cutoff
+
+
+def _remove_frames(x_fft,
+                   distortion_factor,
+                   lowpass_cutoff,
+                   num_points,
+                   sample_rate):
+    """
+    Lowpass filters ``x_fft`` and zeroes a random ``distortion_factor`` of its
+    frames, in place. See ``distorted_target``.
+    """
+
+    cutoff = _lowpass(x_fft, lowpass_cutoff, num_points, sample_rate)
+
+    if distortion_factor is not None:
+
+        num_frames_to_remove = int(x_fft.num_frames * distortion_factor)
+
+        # The frames with the smallest random keys form a uniform sample
+        # without replacement, without permuting every frame index
+        keys = _generator().random(x_fft.num_frames)
+        idx = np.argpartition(keys, num_frames_to_remove - 1)
+        idx = idx[:num_frames_to_remove]
+
+        # Frames only need zeroing below the cutoff
+        x_fft[:cutoff, idx] = 0
+
+    return x_fft
+
+
+def _remove_bins(x_fft,
+                 distortion_factor,
+                 lowpass_cutoff,
+                 num_points,
+                 sample_rate):
+    """
+    Lowpass filters ``x_fft`` and zeroes each remaining time-frequency bin
+    with probability ``distortion_factor``, in place. See ``musical_noise``.
+    """
+
+    cutoff = _lowpass(x_fft, lowpass_cutoff, num_points, sample_rate)
+
+    # Masking one frequency band at a time keeps the random draws and the
+    # mask the size of a band rather than of the whole spectrogram
+    rng = _generator()
+    for band in x_fft[:cutoff]:
+        band *= rng.random(band.shape, dtype=np.float32) >= distortion_factor
+
+    return x_fft
+
+
+def _distorted_and_noise(target,
+                         distortion_factor_target,
+                         distortion_factor_noise,
+                         lowpass_cutoff_target,
+                         lowpass_cutoff_noise,
+                         num_points,
+                         window_type,
+                         precomputed_distorted):
+    """
+    Returns the distorted target and the musical noise parts of a composite
+    anchor, both derived from a single STFT of ``target``. If
+    ``precomputed_distorted`` is given, a copy of it is returned as the
+    distorted target instead, as the caller changes its loudness in place.
+    """
+
+    stft, istft = utilities.stft_istft(num_points, window_type)
+
+    x_fft = stft.process(target)
+
+    if precomputed_distorted is None:
+        x_fft_distorted = _remove_frames(x_fft.copy(),
+                                         distortion_factor_target,
+                                         lowpass_cutoff_target,
+                                         num_points,
+                                         target.sample_rate)
+        distorted = istft.process(x_fft_distorted)[:target.num_frames]
+    else:
+        distorted = audio.Wave(np.array(precomputed_distorted,
+                                        dtype=np.float32),
+                               target.sample_rate)
+
+    _remove_bins(x_fft,
+                 distortion_factor_noise,
+                 lowpass_cutoff_noise,
+                 num_points,
+                 target.sample_rate)
+    noise = istft.process(x_fft)[:target.num_frames]
+
+    return distorted, noise
 
 
 def distorted_target(target,
@@ -71,29 +185,17 @@ def distorted_target(target,
     """
 
     # Setup
-    if not isinstance(target, audio.Wave):
-        target = audio.Wave(target, sample_rate)
+    target = utilities.as_float32_wave(target, sample_rate)
 
     stft, istft = utilities.stft_istft(num_points, window_type)
 
     # Processing
     x_fft = stft.process(target)
-
-    if distortion_factor is not None:
-
-        num_frames_to_remove = int(x_fft.num_frames * distortion_factor)
-
-        idx = np.random.choice(x_fft.num_frames,
-                               num_frames_to_remove,
-                               replace=False)
-
-        x_fft[:, idx] = 0
-
-    if lowpass_cutoff is not None:
-        cutoff = untwist.utilities.conversion.nearest_bin(lowpass_cutoff,
-                                                          num_points,
-                                                          target.sample_rate)
-        x_fft[cutoff:] = 0
+    _remove_frames(x_fft,
+                   distortion_factor,
+                   lowpass_cutoff,
+                   num_points,
+                   target.sample_rate)
 
     distorted_target_anchor = istft.process(x_fft)[:target.num_frames]
     distorted_target_anchor.loudness = target.loudness
@@ -106,10 +208,19 @@ def musical_noise(target,
                   lowpass_cutoff=None,
                   num_points=2048,
                   window_type='hann',
-                  sample_rate=None):
+                  sample_rate=None,
+                  block_samples=None):
     """
     Generates a musical noise artefacts signal by randomly zeroing 99% of the
-    time-frequency bins. You can optionally apply a lowpass filter.
+    time-frequency bins, each bin independently with probability
+    ``distortion_factor``. You can optionally apply a lowpass filter.
+
+    Long signals can be processed in blocks of ``block_samples`` to bound the
+    size of the spectrogram held in memory. Blocks start on hop boundaries and
+    are transformed with ``2 * num_points`` samples of context either side.
+    Each block masks and resynthesises only the frames that start inside it,
+    and the blocks are overlap-added, so the result matches processing the
+    whole signal at once.
 
     Default parameters based on [1].
 
@@ -128,6 +239,10 @@ def musical_noise(target,
         Type of window to use for the FFT (default hann).
     sample_rate : int, optional
         Only needed if Wave objects not provided (default None).
+    block_samples : int, optional
+        Number of samples per processing block, rounded up to a multiple of
+        the hop size ``num_points // 2`` (default None, meaning the whole
+        signal is processed at once).
 
     Returns
     -------
@@ -137,31 +252,58 @@ def musical_noise(target,
     """
 
     # Setup
-    if not isinstance(target, audio.Wave):
-        target = audio.Wave(target, sample_rate)
+    target = utilities.as_float32_wave(target, sample_rate)
 
     stft, istft = utilities.stft_istft(num_points, window_type)
 
     # Processing
-    x_fft = stft.process(target)
+    if block_samples is None:
+
+        x_fft = stft.process(target)
+        _remove_bins(x_fft,
+                     distortion_factor,
+                     lowpass_cutoff,
+                     num_points,
+                     target.sample_rate)
+
+        artefacts = istft.process(x_fft)
 
-    idx = np.random.choice(
-        x_fft.size,
-        size=int(x_fft.size * distortion_factor),
-        replace=False)
-    freq, time, channel = np.unravel_index(idx, x_fft.shape)
+        return artefacts[:target.num_frames]
 
-    x_fft[freq, time, channel] = 0
+    num_frames = target.num_frames
+    hop = num_points // 2
+    context = 4 * hop
+    block_samples = max(-(-block_samples // hop) * hop, hop)
 
-    if lowpass_cutoff is not None:
-        cutoff = untwist.utilities.conversion.nearest_bin(lowpass_cutoff,
-                                                          num_points,
-                                                          target.sample_rate)
-        x_fft[cutoff:] = 0
+    artefacts = np.zeros_like(target)
 
-    artefacts = istft.process(x_fft)
+    for start in range(0, num_frames, block_samples):
 
-    return artefacts[:target.num_frames]
+        stop = min(start + block_samples, num_frames)
+        first = max(start - context, 0)
+        last = min(stop + context, num_frames)
+
+        # As first is a multiple of the hop, frame i of this block is frame
+        # i + first // hop of the whole signal
+        x_fft = stft.process(target[first:last])
+
+        own_start = (start - first) // hop
+        if stop < num_frames:
+            own_stop = (stop - first) // hop
+        else:
+            own_stop = x_fft.num_frames
+
+        x_fft[:, :own_start] = 0
+        x_fft[:, own_stop:] = 0
+        _remove_bins(x_fft[:, own_start:own_stop],
+                     distortion_factor,
+                     lowpass_cutoff,
+                     num_points,
+                     target.sample_rate)
+
+        artefacts[first:last] += istft.process(x_fft)[:last - first]
+
+    return artefacts
 
 
 def artefacts(target,
@@ -200,6 +342,8 @@ def artefacts(target,
         Target source plus musical noise.
     """
 
+    target = utilities.as_float32_wave(target, sample_rate)
+
     artefacts = musical_noise(target,
                               distortion_factor,
                               lowpass_cutoff,
@@ -271,7 +415,8 @@ def overall_quality(target,
                     relative_loudness=0,
                     num_points=2048,
                     window_type='hann',
-                    sample_rate=None):
+                    sample_rate=None,
+                    precomputed_distorted=None):
     """
     Generates an overall quality anchor, defined as the sum of the lowpass
     filtered target, an artefacts signal and an interferering signal; all
@@ -308,6 +453,10 @@ def overall_quality(target,
         Type of window to use for the FFT (default hann)
     sample_rate : int, optional
         Only needed if Wave objects not provided (default None).
+    precomputed_distorted : np.ndarray or Wave, optional
+        Lowpass filtered target, as returned by ``distorted_target`` with the
+        target parameters above, to use instead of computing it here (default
+        None).
 
     Returns
     -------
@@ -321,21 +470,18 @@ def overall_quality(target,
                                                            others,
                                                            sample_rate)
 
-    signals_to_sum = [
+    distorted, noise = _distorted_and_noise(target,
+                                            distortion_factor_target,
+                                            distortion_factor_noise,
+                                            lowpass_cutoff_target,
+                                            lowpass_cutoff_noise,
+                                            num_points,
+                                            window_type,
+                                            precomputed_distorted)
 
-        distorted_target(target,
-                         distortion_factor_target,
-                         lowpass_cutoff_target,
-                         num_points,
-                         window_type,
-                         sample_rate),
-
-        musical_noise(target,
-                      distortion_factor_noise,
-                      lowpass_cutoff_noise,
-                      num_points,
-                      window_type,
-                      sample_rate),
+    signals_to_sum = [
+        distorted,
+        noise,
         accompaniment
     ]
 
@@ -344,7 +490,7 @@ def overall_quality(target,
 
     signals_to_sum[2].loudness = -23 + relative_loudness
 
-    overall_quality_anchor = sum(signals_to_sum)[:target.num_frames]
+    overall_quality_anchor = utilities.sum_signals(signals_to_sum)
     overall_quality_anchor.loudness = target.loudness
 
     return overall_quality_anchor
@@ -357,7 +503,8 @@ def target_sound_quality(target,
                          lowpass_cutoff_noise=3500,
                          num_points=2048,
                          window_type='hann',
-                         sample_rate=None):
+                         sample_rate=None,
+                         precomputed_distorted=None):
     """
     Generates a target sound quality anchor, defined as the sum of the
     distorted target and an artefacts signal, both equally loud.
@@ -386,6 +533,10 @@ def target_sound_quality(target,
         Type of window to use for the FFT (default hann).
     sample_rate : int, optional
         Only needed if Wave objects not provided (default None).
+    precomputed_distorted : np.ndarray or Wave, optional
+        Lowpass filtered and time-distorted target, as returned by
+        ``distorted_target`` with the target parameters above, to use instead
+        of computing it here (default None).
 
     Returns
     -------
@@ -394,30 +545,26 @@ def target_sound_quality(target,
         Lowpass filtered and time-distorted target source plus musical_noise.
     """
 
-    if not isinstance(target, audio.Wave):
-        target = audio.Wave(target, sample_rate)
+    target = utilities.as_float32_wave(target, sample_rate)
 
-    signals_to_sum = [
+    distorted, noise = _distorted_and_noise(target,
+                                            distortion_factor_target,
+                                            distortion_factor_noise,
+                                            lowpass_cutoff_target,
+                                            lowpass_cutoff_noise,
+                                            num_points,
+                                            window_type,
+                                            precomputed_distorted)
 
-        distorted_target(target,
-                         distortion_factor_target,
-                         lowpass_cutoff_target,
-                         num_points,
-                         window_type,
-                         sample_rate),
-
-        musical_noise(target,
-                      distortion_factor_noise,
-                      lowpass_cutoff_noise,
-                      num_points,
-                      window_type,
-                      sample_rate),
+    signals_to_sum = [
+        distorted,
+        noise,
     ]
 
     for signal in signals_to_sum:
         signal.loudness = -23
 
-    target_sound_quality_anchor = sum(signals_to_sum)[:target.num_frames]
+    target_sound_quality_anchor = utilities.sum_signals(signals_to_sum)
     target_sound_quality_anchor.loudness = target.loudness
 
     return target_sound_quality_anchor
@@ -1,7 +1,8 @@
 from __future__ import division
 import os
-from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import numpy as np
 from untwist.data.audio import Wave
 from .utilities import ensure_audio_doesnt_clip
 from . import (distorted_target,
@@ -11,6 +12,37 @@ from . import (distorted_target,
                overall_quality)
 
 
+_ANCHORS = {
+    'distorted_target': distorted_target,
+    'artefacts': artefacts,
+    'target_sound_quality': target_sound_quality,
+    'interference': interference,
+    'overall_quality': overall_quality,
+}
+
+
+def _generate_anchor(name, target, others, sample_rate, **kwargs):
+    """
+    Generates a single anchor in a worker process. The target and other
+    sources are passed as plain arrays along with their sample rate, and the
+    anchor is returned as a plain array. Keyword arguments are passed on to
+    the anchor function.
+    """
+
+    # Forked workers inherit the parent's random state
+    np.random.seed()
+
+    target = Wave(target, sample_rate)
+
+    if others is None:
+        anchor = _ANCHORS[name](target, **kwargs)
+    else:
+        others = [Wave(_, sample_rate) for _ in others]
+        anchor = _ANCHORS[name](target, others, **kwargs)
+
+    return np.asarray(anchor)
+
+
 def ssanchors(argv=None):
 
     parser = argparse.ArgumentParser()
@@ -55,6 +87,12 @@ def ssanchors(argv=None):
         action='store_true',
         help='Generates all anchors')
 
+    parser.add_argument(
+        '--reuse_distorted',
+        action='store_true',
+        help='Build the target sound quality anchor from the distorted target '
+             'anchor, so both share the same frame dropouts')
+
     args = parser.parse_args()
 
     '''
@@ -63,24 +101,29 @@ def ssanchors(argv=None):
 
     target = Wave.read(args.target)
 
-    if args.others is not None:
-        others = [Wave.read(_) for _ in args.others]
+    samples = np.asarray(target)
+
+    # The other sources are only read if an anchor needs them
+    needs_others = args.interference or args.overall_quality or args.all
+    if needs_others and args.others is not None:
+        others = [np.asarray(Wave.read(_)) for _ in args.others]
     else:
         others = False
 
-    anchors = OrderedDict()
+    # Maps each requested anchor to the other sources it needs
+    jobs = {}
     if args.distorted_target or args.all:
-        anchors['distorted_target'] = distorted_target(target)
+        jobs['distorted_target'] = None
 
     if args.artefacts or args.all:
-        anchors['artefacts'] = artefacts(target)
+        jobs['artefacts'] = None
 
     if args.target_sound_quality or args.all:
-        anchors['target_sound_quality'] = target_sound_quality(target)
+        jobs['target_sound_quality'] = None
 
     if args.interference or args.all:
         if others:
-            anchors['interference'] = interference(target, others)
+            jobs['interference'] = others
         else:
             print(
                 'Cannot create interference anchor as '
@@ -89,13 +132,48 @@ def ssanchors(argv=None):
 
     if args.overall_quality or args.all:
         if others:
-            anchors['overall_quality'] = overall_quality(target, others)
+            jobs['overall_quality'] = others
         else:
             print(
                 'Cannot create overall quality anchor as '
                 'no other sources provided'
             )
 
+    # The target sound quality anchor contains a distorted target generated
+    # with the same parameters, which can optionally be reused. By default
+    # each stimulus gets its own dropouts.
+    reuse_distorted = (args.reuse_distorted and
+                       'distorted_target' in jobs and
+                       'target_sound_quality' in jobs)
+
+    # The remaining anchors are independent, so generate them in parallel
+    with ProcessPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+
+        futures = {}
+        for name, sources in jobs.items():
+            if name == 'target_sound_quality' and reuse_distorted:
+                continue
+            futures[name] = executor.submit(_generate_anchor,
+                                            name,
+                                            samples,
+                                            sources,
+                                            target.sample_rate)
+
+        if reuse_distorted:
+            futures['target_sound_quality'] = executor.submit(
+                _generate_anchor,
+                'target_sound_quality',
+                samples,
+                None,
+                target.sample_rate,
+                precomputed_distorted=futures['distorted_target'].result()
+            )
+
+        anchors = {
+            name: Wave(futures[name].result(), target.sample_rate)
+            for name in jobs
+        }
+
     keys, anchors = anchors.keys(), anchors.values()
     anchors = ensure_audio_doesnt_clip(anchors)
 
@@ -1,7 +1,75 @@
 from __future__ import division
+from functools import lru_cache
 import numpy as np
 from untwist import data
 from untwist import transforms
+import untwist.utilities
+
+
+# Windows for the default transform configuration, built once at import. The
+# periodic Hann window matches scipy.signal.get_window('hann', 2048).
+_WINDOWS = {
+    ('hann', 2048): np.hanning(2048 + 1)[:-1].astype(np.float32),
+}
+
+
+def as_float32_wave(x, sample_rate=None):
+    """
+
+    Returns ``x`` as a C-contiguous float32 Wave, without copying if it
+    already is one.
+
+    Parameters
+    ----------
+
+    x : np.ndarray or Wave, shape=(num_samples, num_channels)
+        The signal.
+    sample_rate : int, optional
+        Only needed if a Wave object is not provided.
+
+    Returns
+    -------
+    x : Wave, shape=(num_samples, num_channels)
+
+    """
+
+    if not isinstance(x, data.audio.Wave):
+        x = data.audio.Wave(x, sample_rate)
+
+    return x.astype(np.float32, order='C', copy=False)
+
+
+def sum_signals(signals):
+    """
+
+    Sums a list of signals. The sum is accumulated in place into the first
+    signal, which is therefore overwritten, unless the signals broadcast to a
+    larger shape (e.g. a mono and a stereo signal). In that case the first
+    addition allocates the full-size result.
+
+    Parameters
+    ----------
+
+    signals : list
+        A list of np.ndarray or Wave objects.
+
+    Returns
+    -------
+    total : np.ndarray or Wave
+        The sum of the signals.
+
+    """
+
+    shape = np.broadcast_shapes(*(_.shape for _ in signals))
+
+    total = signals[0]
+    for signal in signals[1:]:
+        if total.shape == shape:
+            total += signal
+        else:
+            total = total + signal
+
+    return total
 
 
 def target_accompaniment(target, others, sample_rate=None):
@@ -35,32 +103,66 @@ def target_accompaniment(target, others, sample_rate=None):
         if not isinstance(others[0], data.audio.Wave):
             others = [data.audio.Wave(_, sample_rate) for _ in others]
 
-        accompaniment = sum(other for other in others)
+        # Accumulate into a (float32) copy of the first source
+        accompaniment = sum_signals(
+            [others[0].astype(np.float32, order='C')] + others[1:]
+        )
 
     else:
 
-        if not isinstance(others, data.audio.Wave):
-            others = data.audio.Wave(others, sample_rate)
+        accompaniment = as_float32_wave(others, sample_rate)
 
-        accompaniment = others
-
-    if not isinstance(target, data.audio.Wave):
-        target = data.audio.Wave(target, sample_rate)
+    target = as_float32_wave(target, sample_rate)
 
     return target, accompaniment
 
 
+@lru_cache(maxsize=32)
+def nearest_bin(frequency, num_points, sample_rate):
+    """
+
+    Returns the index of the FFT bin nearest to ``frequency``. Results are
+    cached, as the same cutoff is looked up for every anchor.
+
+    Parameters
+    ----------
+
+    frequency : float
+        Frequency in Hz.
+    num_points : int
+        The number of points used for the fft transform.
+    sample_rate : int
+        The sample rate of the signal.
+
+    Returns
+    -------
+    bin : int
+        The nearest bin index.
+    """
+
+    return untwist.utilities.conversion.nearest_bin(frequency,
+                                                    num_points,
+                                                    sample_rate)
+
+
+@lru_cache(maxsize=8)
 def stft_istft(num_points=2048, window='hann'):
     """
 
     Returns an STFT and an ISTFT Processor object, both configured with the
-    same window and transform length. These objects are to be used as follows:
+    same window and transform length. The pair is cached, so repeated calls
+    with the same arguments return the same objects. These objects are to be
+    used as follows:
 
         >>> stft, istft = stft_istft()
         >>> x = untwist.data.audio.Wave.tone() # Or some Wave
         >>> y = stft.process(x)
         >>> x = istft.process(y)
 
+    Waves passed to the STFT should be C-contiguous with shape
+    (num_samples, num_channels), so that every frame spans all channels in one
+    contiguous block of memory.
+
     Parameters
     ----------
 
@@ -77,13 +179,34 @@ def stft_istft(num_points=2048, window='hann'):
         An ISTFT processor.
     """
 
+    window = _WINDOWS.get((window, num_points), window)
+
     stft = transforms.STFT(window, num_points, num_points // 2)
     istft = transforms.ISTFT(window, num_points, num_points // 2)
 
     return stft, istft
 
 
-def ensure_audio_doesnt_clip(list_of_arrays):
+def _peak(audio):
+    """
+    Returns the largest absolute sample value of ``audio``.
+    """
+
+    audio = np.asarray(audio)
+
+    # Python floats, so negating the minimum of a signed integer array can't
+    # overflow
+    peak = max(-float(audio.min()), float(audio.max()))
+
+    # Non-finite samples are rare, so only then rescan without them
+    if not np.isfinite(peak):
+        finite = audio[np.isfinite(audio)]
+        peak = max(-float(finite.min(initial=0)), float(finite.max(initial=0)))
+
+    return peak
+
+
+def ensure_audio_doesnt_clip(list_of_arrays, copy=False):
     """
 
     Takes a list of arrays and scales them by the same factor such that
@@ -93,7 +216,13 @@ def ensure_audio_doesnt_clip(list_of_arrays):
     ----------
 
     list_of_arrays : list
-        A list of array_like objects
+        A list of np.ndarray or Wave objects
+    copy : bool, optional
+        If False, floating point arrays are scaled in place; otherwise scaled
+        copies are returned and the input arrays are left untouched. Integer
+        arrays are always copied, as they can't hold the scaled samples, as
+        are arrays that share memory with another entry of the list, so that
+        no buffer is scaled twice (default False).
 
     Returns
     -------
@@ -102,22 +231,38 @@ def ensure_audio_doesnt_clip(list_of_arrays):
         A list of scaled array_like objects.
     """
 
-    max_peak = 1
-    for audio in list_of_arrays:
-        audio_peak = np.max(np.abs(audio))
-        if audio_peak > max_peak:
-            max_peak = audio_peak
+    peaks = np.fromiter((_peak(audio) for audio in list_of_arrays),
+                        dtype=np.float64)
+    # A non-finite peak would turn the gain into NaN or 0 for every array
+    max_peak = peaks[np.isfinite(peaks)].max(initial=0)
 
-    if max_peak >= 1:
+    if max_peak < 1:
+        return list_of_arrays
 
-        print('Warning: Audio has been attenuated to prevent clipping')
+    print('Warning: Audio has been attenuated to prevent clipping')
 
-        gain = 0.999 / max_peak
-        new_list_of_arrays = []
-        for audio in list_of_arrays:
-            new_list_of_arrays.append(audio * gain)
-    else:
+    gain = 0.999 / max_peak
+
+    list_of_arrays = list(list_of_arrays)
+
+    # Arrays that share memory with another entry (repeats or views of one
+    # buffer) are copied, so that no samples are scaled twice
+    in_place = [
+        not copy and
+        np.issubdtype(audio.dtype, np.inexact) and
+        not any(np.may_share_memory(audio, other)
+                for j, other in enumerate(list_of_arrays) if j != i)
+        for i, audio in enumerate(list_of_arrays)
+    ]
+
+    # All copies are made before any array is modified
+    new_list_of_arrays = [
+        audio if scale_in_place else audio * gain
+        for audio, scale_in_place in zip(list_of_arrays, in_place)
+    ]
 
-        new_list_of_arrays = list_of_arrays
+    for audio, scale_in_place in zip(new_list_of_arrays, in_place):
+        if scale_in_place:
+            audio *= gain
 
     return new_list_of_arrays